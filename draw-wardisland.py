@@ -4,6 +4,7 @@
 # - https://www.labri.fr/perso/nrougier/python-opengl/
 
 from random import randint
+from collections import OrderedDict
 import numpy as np
 from glumpy import app, gloo, gl, glm, transforms
 from glumpy.ext import png
@@ -62,6 +63,36 @@ def gradiantOpacity(vertices, source):
     dists = (dists - np.min(dists))/np.ptp(dists)
     return dists
 
+def splatSegments(trajs, width, height):
+    # Pair samples the way GL_LINES does: (0,1), (2,3), ...
+    a = trajs[:, 0:-1:2].reshape(-1, 2)
+    b = trajs[:, 1::2].reshape(-1, 2)
+    # One sample per pixel along each segment
+    d = (b - a) * (width / 2, height / 2)
+    n = np.ceil(np.abs(d).max(axis = 1)).astype(int) + 1
+    seg = np.repeat(np.arange(n.shape[0]), n)
+    start = np.repeat(np.cumsum(n) - n, n)
+    s = (np.arange(n.sum()) - start) / np.repeat(np.maximum(n - 1, 1), n)
+    return a[seg] + (b - a)[seg] * s[:, None]
+
+def accumulateDensity(density, trajs, splat = False):
+    # Bin trajectory samples (world coords) into density (rows = y, cols = x)
+    height, width = density.shape
+    points = splatSegments(trajs, width, height) if splat else trajs.reshape(-1, 2)
+    cols = np.floor((points[:, 0] + 1) / 2 * width).astype(int)
+    rows = np.floor((points[:, 1] + 1) / 2 * height).astype(int)
+    inside = (cols >= 0) & (cols < width) & (rows >= 0) & (rows < height)
+    density += np.bincount(rows[inside] * width + cols[inside],
+                           minlength = width * height).reshape(height, width)
+
+def toneMap(density, color, maxAlpha = 0.9):
+    # Log-scale counts to alpha so sparse strands stay visible
+    rgba = np.zeros((density.shape[0], density.shape[1], 4), dtype = np.float32)
+    rgba[..., :3] = color
+    if density.max() > 0:
+        rgba[..., 3] = maxAlpha * np.log1p(density) / np.log1p(density.max())
+    return (rgba * 255).astype(np.uint8)
+
 
 vertex = """
     attribute vec2 position;
@@ -91,6 +122,20 @@ fragment_var = """
     varying vec4 v_color;
     void main() { gl_FragColor = v_color; } """
 
+vertex_tex = """
+    attribute vec2 position;
+    attribute vec2 texcoord;
+    varying vec2 v_texcoord;
+    void main(){
+        gl_Position = vec4(position, 0.0, 1.0);
+        v_texcoord = texcoord;
+    } """
+
+fragment_tex = """
+    uniform sampler2D texture;
+    varying vec2 v_texcoord;
+    void main() { gl_FragColor = texture2D(texture, v_texcoord); } """
+
 # Colors
 debug = np.array((255, 0, 0)) / 255
 sand = np.array((245, 240, 188)) / 255
@@ -125,10 +170,15 @@ waters = [ np.array((163, 201, 196)) / 255,
            np.array((173, 192, 204)) / 255,
          ]
 
-# Shapes, curves
+# Shapes, curves, textured quads
 shapes = []
 curves = []
 curves_loop = []
+quads = []
+
+# Output resolution
+winWidth  = 512
+winHeight = 512
 
 #########
 # Water #
@@ -617,7 +667,66 @@ env = { "v"  : inter_v,
         "hj" : Yres,
       }
 
+# Time-varying wind: .npy stack of (u, v) planes, shape (frames, 2, rows, cols)
+windSeriesPath   = None   # Replaces the static env when set
+windSeriesDt     = 1.0    # Simulation time between frames
+windSeriesWindow = 4      # Frames kept in memory (>= 2)
+
+def loadWindSeries(path, dt = 1.0, window = 4):
+    # Memory-map the stack; frames are copied in only when needed
+    stack = np.load(path, mmap_mode = 'r')
+    return { "stack"   : stack,
+             "dt"      : dt,
+             "window"  : max(window, 2),
+             "frames"  : OrderedDict(),
+             "current" : None,
+             "wi"      : abs(1 - (-1)),
+             "hi"      : abs(1 - (-1)),
+             "wj"      : stack.shape[3],
+             "hj"      : stack.shape[2],
+           }
+
+def windFrames(env, k):
+    # LRU cache: make frames k .. k + window - 1 resident, evict the oldest
+    frames = env["frames"]
+    last = env["stack"].shape[0] - 1
+    if k != env["current"]:
+        for j in range(k, min(k + env["window"], last + 1)):
+            if j in frames:
+                frames.move_to_end(j)
+            else:
+                frames[j] = np.array(env["stack"][j])
+        while len(frames) > env["window"]:
+            frames.popitem(last = False)
+        env["current"] = k
+    return frames[k], frames[min(k + 1, last)]
+
+def windAt(env, erow, ecol, t = 0):
+    # Static field
+    if "stack" not in env:
+        return env["v"][erow, ecol], env["u"][erow, ecol]
+    # Linear interpolation between the frames either side of t
+    last = env["stack"].shape[0] - 1
+    s = min(max(t / env["dt"], 0), last)
+    k = min(int(s), max(last - 1, 0))
+    w = s - k
+    f0, f1 = windFrames(env, k)
+    e_u = (1 - w) * f0[0][erow, ecol] + w * f1[0][erow, ecol]
+    e_v = (1 - w) * f0[1][erow, ecol] + w * f1[1][erow, ecol]
+    return e_v, e_u
+
+if windSeriesPath is not None:
+    env = loadWindSeries(windSeriesPath, windSeriesDt, windSeriesWindow)
+
 numAgents = 5500
+# "lines"   : one GL_LINES program per trajectory (cost grows with numAgents)
+# "density" : bin all trajectories into one texture (cost independent of numAgents)
+windMode = "lines"
+densitySplat = False   # Rasterize segments instead of binning samples only
+# Agents recorded per pass, bounds trajectory memory. Each pass restarts
+# simulation time, so with a wind series line mode records in one pass instead
+# (density mode keeps chunking and re-reads the series once per pass).
+agentChunk = 1000
 dirs = np.linspace(-np.pi/2, np.pi/2, numAgents)
 mags = np.cos(np.linspace(0, 100, numAgents))
 ypos = np.linspace(-1, 1, numAgents)
@@ -627,54 +736,69 @@ uvec = mags * np.cos(dirs)
 
 agents = np.column_stack((ypos, xpos, vvec, uvec))
 
-def moveAgent(agent, time = 0.05, env = None):
-    # Agent : (y, x, v, u)
-    e_v = 0.0
-    e_u = 0.0
+def moveAgents(agents, time = 0.05, env = None, t = 0):
+    # Agents : rows of (y, x, v, u), t : simulation time (for time-varying env)
+    e_v = np.zeros(agents.shape[0])
+    e_u = np.zeros(agents.shape[0])
     if env is not None:
         # Convert world coords to env coords
-        ylen = agent[0] + 1
-        xlen = agent[1] + 1
-        erow = int(np.floor(env["hj"] * (ylen / env["hi"])))
-        ecol = int(np.floor(env["wj"] * (xlen / env["wi"])))
-        if erow < 0 and ecol < env["u"].shape[1]:
-            e_v =  4.7
-            e_u =  1.7
-        elif erow < 0 and ecol >= env["u"].shape[1]:
-            e_v =  4.3
-            e_u = -2.5
-        try:
-            e_v  = env["v"][erow][ecol]
-            e_u  = env["u"][erow][ecol]
-        except:
-            pass
-
-    # Move agent with velocity for duration
+        ylen = agents[:, 0] + 1
+        xlen = agents[:, 1] + 1
+        erow = np.floor(env["hj"] * (ylen / env["hi"])).astype(int)
+        ecol = np.floor(env["wj"] * (xlen / env["wi"])).astype(int)
+        above = erow < 0
+        left  = ecol < env["wj"]
+        e_v[above &  left] =  4.7
+        e_u[above &  left] =  1.7
+        e_v[above & ~left] =  4.3
+        e_u[above & ~left] = -2.5
+        # Field lookup wherever indexing succeeds (negative indices wrap)
+        inside = ((erow >= -env["hj"]) & (erow < env["hj"]) &
+                  (ecol >= -env["wj"]) & (ecol < env["wj"]))
+        e_v[inside], e_u[inside] = windAt(env, erow[inside], ecol[inside], t)
+
+    # Move agents with velocity for duration
     # (pos_new = pos_old + velocity * tme)
-    agent[0] = agent[0] + (agent[2] + e_v) * time
-    agent[1] = agent[1] + (agent[3] + e_u) * time
+    agents[:, 0] = agents[:, 0] + (agents[:, 2] + e_v) * time
+    agents[:, 1] = agents[:, 1] + (agents[:, 3] + e_u) * time
 
-def recordAgent(agent, time = 0.05, duration = 10, env = None):
+def recordAgents(agents, time = 0.05, duration = 10, env = None):
+    # Step all agents together so a time-varying env is read frame by frame
     iters = int(np.ceil(duration / time))
-    trajectory = np.zeros((iters, 2))
+    trajectories = np.zeros((agents.shape[0], iters, 2))
     for i in range(iters):
-        trajectory[i] = (agent[1], (-1) * agent[0])
-        moveAgent(agent, time, env)
-    trajectory[i] = (agent[1], (-1) * agent[0])
-    return trajectory
-
-for agent in agents:
-    traj = recordAgent(agent, time = 0.005, env = env)
-    # Trajectory to line object
-    traj_line               = gloo.Program(vertex_m, fragment_uni, count = traj.shape[0])
-    traj_line["position"]   = traj
-    traj_line["color"]      = (*bldgs[0], 0.4)
-    traj_line_model = np.eye(4, dtype=np.float32)
-    ##glm.rotate(bldg_en_model, 0.5, 1, 1, 1)
-    #glm.scale(bldg_en_model, 0.02, .04, 1)
-    #glm.translate(bldg_en_model, -.25, .16, 0.0)
-    traj_line["model"] = traj_line_model
-    curves.append(traj_line)
+        trajectories[:, i, 0] = agents[:, 1]
+        trajectories[:, i, 1] = (-1) * agents[:, 0]
+        moveAgents(agents, time, env, t = i * time)
+    trajectories[:, i, 0] = agents[:, 1]
+    trajectories[:, i, 1] = (-1) * agents[:, 0]
+    return trajectories
+
+if windMode == "density":
+    density = np.zeros((winHeight, winWidth))
+    for c in range(0, numAgents, agentChunk):
+        trajs = recordAgents(agents[c:c + agentChunk], time = 0.005, env = env)
+        accumulateDensity(density, trajs, splat = densitySplat)
+    # Density grid to single textured quad
+    wind_quad               = gloo.Program(vertex_tex, fragment_tex, count = 4)
+    wind_quad["position"]   = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+    wind_quad["texcoord"]   = [( 0,  0), ( 0, 1), (1,  0), (1, 1)]
+    wind_quad["texture"]    = toneMap(density, bldgs[0])
+    quads.append(wind_quad)
+else:
+    lineChunk = numAgents if "stack" in env else agentChunk
+    for c in range(0, numAgents, lineChunk):
+        for traj in recordAgents(agents[c:c + lineChunk], time = 0.005, env = env):
+            # Trajectory to line object
+            traj_line               = gloo.Program(vertex_m, fragment_uni, count = traj.shape[0])
+            traj_line["position"]   = traj
+            traj_line["color"]      = (*bldgs[0], 0.4)
+            traj_line_model = np.eye(4, dtype=np.float32)
+            ##glm.rotate(bldg_en_model, 0.5, 1, 1, 1)
+            #glm.scale(bldg_en_model, 0.02, .04, 1)
+            #glm.translate(bldg_en_model, -.25, .16, 0.0)
+            traj_line["model"] = traj_line_model
+            curves.append(traj_line)
 
 
 ################
@@ -682,25 +806,96 @@ for agent in agents:
 ################
 
 # Create a window with a valid GL context
-window = app.Window()
+window = app.Window(width = winWidth, height = winHeight)
 framebuffer = np.zeros((window.height, window.width * 3), dtype=np.uint8)
 
-# Tell glumpy what needs to be done at each redraw
-@window.event
-def on_draw(dt):
-    window.clear()
-    for shape in shapes:
-        shape.draw(gl.GL_TRIANGLE_STRIP)
+##############
+# Compositor #
+##############
+
+# Static layers (layer, primitive) are drawn once, in order, into an offscreen
+# texture that is blitted each frame. Call invalidateComposite() after changing
+# any of their data or model matrices.
+static_layers  = [ (shapes, gl.GL_TRIANGLE_STRIP),
+                   (curves_loop, gl.GL_LINE_LOOP),
+                   (curves, gl.GL_LINES),
+                   (quads, gl.GL_TRIANGLE_STRIP),
+                 ]
+# Dynamic layers (animated agents, overlays) are redrawn on top every frame
+dynamic_layers = []
+
+composite = { "fbo"   : None,
+              "quad"  : None,
+              "valid" : False,
+              "save"  : True,    # Write wardisland.png after the first build
+            }
+
+def buildComposite(width, height):
+    texture = np.zeros((height, width, 4), dtype = np.uint8).view(gloo.Texture2D)
+    quad               = gloo.Program(vertex_tex, fragment_tex, count = 4)
+    quad["position"]   = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
+    quad["texcoord"]   = [( 0,  0), ( 0, 1), (1,  0), (1, 1)]
+    quad["texture"]    = texture
+    composite["fbo"]   = gloo.FrameBuffer(color = [texture])
+    composite["quad"]  = quad
+    composite["valid"] = False
+
+def resizeComposite(width, height):
+    # Reallocate only the colour attachment (the fbo deletes the old one)
+    fbo = composite["fbo"]
+    if (width, height) == (fbo.width, fbo.height):
+        return
+    fbo.resize(width, height)
+    composite["quad"]["texture"] = fbo.color[0]
+    composite["valid"] = False
+
+def invalidateComposite():
+    composite["valid"] = False
+
+def saveComposite(filename = 'wardisland.png'):
+    # Read the cached static layers back and write them out
+    fbo = composite["fbo"]
+    fbo.activate()
+    gl.glReadPixels(0, 0, fbo.width, fbo.height,
+           gl.GL_RGB, gl.GL_UNSIGNED_BYTE, framebuffer)
+    fbo.deactivate()
+    png.from_array(np.flipud(framebuffer), 'RGB').save(filename)
 
-    for curve_loop in curves_loop:
-        curve_loop.draw(gl.GL_LINE_LOOP)
+def drawLayers(layers):
+    for layer, primitive in layers:
+        for program in layer:
+            program.draw(primitive)
 
-    for curve in curves:
-        curve.draw(gl.GL_LINES)
+buildComposite(window.width, window.height)
 
-    gl.glReadPixels(0, 0, window.width, window.height,
-           gl.GL_RGB, gl.GL_UNSIGNED_BYTE, framebuffer)
-    png.from_array(np.flipud(framebuffer), 'RGB').save('wardisland.png')
+@window.event
+def on_resize(width, height):
+    global framebuffer
+    # Minimised window: nothing to draw into
+    if width == 0 or height == 0:
+        return
+    gl.glViewport(0, 0, width, height)
+    framebuffer = np.zeros((height, width * 3), dtype=np.uint8)
+    resizeComposite(width, height)
+
+# Tell glumpy what needs to be done at each redraw
+@window.event
+def on_draw(dt):
+    if not composite["valid"]:
+        composite["fbo"].activate()
+        window.clear()
+        drawLayers(static_layers)
+        composite["fbo"].deactivate()
+        composite["valid"] = True
+        if composite["save"]:
+            saveComposite()
+            composite["save"] = False
+
+    # Blit cached static layers as-is (no blending), then dynamic ones on top
+    gl.glDisable(gl.GL_BLEND)
+    composite["quad"].draw(gl.GL_TRIANGLE_STRIP)
+    gl.glEnable(gl.GL_BLEND)
+    drawLayers(dynamic_layers)
 
 # Run the app
 app.run()